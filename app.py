@@ -1,22 +1,38 @@
 # app.py
 
 import os
-import io
 import streamlit as st
-import pandas as pd
-from openai import OpenAI
 
-# Optional PDF support
-try:
-    import pypdf
-except ImportError:
-    pypdf = None
-
-
-# ---------- OpenAI client ----------
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-MODEL_SUMMARY = "gpt-4.1-mini"
-MODEL_CHAT = "gpt-4.1-mini"
+from core import (
+    build_context,
+    CHAT_SYSTEM_PROMPT,
+    chat_with_report,
+    compact_sentences,
+    embed_text,
+    fit_budget,
+    format_questions,
+    get_summary_cache,
+    init_state,
+    iter_report_sections,
+    iter_streaming,
+    load_report_text,
+    lookup_answer,
+    match_locally,
+    prompt_tokens,
+    relevant_excerpts,
+    remember_summary,
+    REPORT_CONTEXT_TOKENS,
+    reset_chat,
+    run_async,
+    split_answers,
+    split_questions,
+    StreamBuffer,
+    submit_async,
+    summarize_pipeline,
+    summary_cache_key,
+    TABLE_EXTENSIONS,
+    update_history_summary,
+)
 
 
 # ---------- Header ----------
@@ -31,126 +47,44 @@ def show_header():
     st.markdown("---")
 
 
-# ---------- File parsing ----------
-def extract_text_from_pdf(file) -> str:
-    if pypdf is None:
-        return "PDF support not available. Install pypdf."
-
-    reader = pypdf.PdfReader(file)
-    pages = []
-    for p in reader.pages:
+# ---------- Summary ----------
+def set_report(report_text: str, summary: str, key: str, name: str):
+    st.session_state.report_text = report_text
+    st.session_state.summary = summary
+
+    # The condensed head of the report goes in the fixed context; the rest is
+    # searched per question
+    sentences = compact_sentences(report_text, tabular=name.lower().endswith(TABLE_EXTENSIONS))
+    head = fit_budget(sentences, REPORT_CONTEXT_TOKENS - prompt_tokens(CHAT_SYSTEM_PROMPT))
+    st.session_state.report_msg = build_context("\n".join(sentences[:head]), summary)
+    st.session_state.report_sentences = sentences
+    st.session_state.report_overflow = sentences[head:]
+    st.session_state.last_file_key = key
+    reset_chat()
+
+
+def show_summary_progress():
+    # Runs as a fragment polling the background summary, so the rest of the
+    # page stays interactive while it is generated
+    job = st.session_state.summary_job
+    if job is None:
+        return
+    if job["future"].done():
+        st.session_state.summary_job = None
         try:
-            pages.append(p.extract_text() or "")
-        except:
-            pages.append("")
-    return "\n\n".join(pages)
-
-
-def extract_text_from_csv(file) -> str:
-    df = pd.read_csv(file)
-    return df.to_string(index=False)
-
-
-def extract_text_from_excel(file) -> str:
-    xls = pd.ExcelFile(file)
-    out = []
-    for sheet in xls.sheet_names:
-        df = xls.parse(sheet)
-        out.append(f"== Sheet: {sheet} ==\n{df.to_string(index=False)}")
-    return "\n\n".join(out)
-
-
-def load_report_text(uploaded_file) -> str:
-    if uploaded_file is None:
-        return ""
-
-    bytes_data = uploaded_file.read()
-    buffer = io.BytesIO(bytes_data)
-    name = uploaded_file.name.lower()
-
-    if name.endswith(".pdf"):
-        return extract_text_from_pdf(buffer)
-    elif name.endswith(".csv"):
-        return extract_text_from_csv(buffer)
-    elif name.endswith((".xlsx", ".xls")):
-        return extract_text_from_excel(buffer)
-    elif name.endswith(".txt"):
-        return bytes_data.decode(errors="ignore")
+            report_text, summary = job["future"].result()
+        except Exception as e:
+            # Remembered so reruns do not resend the same file to the API
+            st.session_state.summary_failure = {"key": job["key"], "error": str(e)}
+            st.rerun()
+        remember_summary(job["key"], summary)
+        set_report(report_text, summary, job["key"], job["name"])
+        st.rerun()
+
+    if job["buffer"].text:
+        st.markdown(job["buffer"].text)
     else:
-        try:
-            return bytes_data.decode(errors="ignore")
-        except:
-            return "Unsupported file format."
-
-
-# ---------- LLM handlers ----------
-def generate_summary(report_text: str) -> str:
-    prompt = (
-        "You are the Duravant Digital Assistant. Summarize the following report using this structure:\n\n"
-        "1. Summary of Issue or Topic\n"
-        "2. Technical Findings / Key Details\n"
-        "3. Business Impact\n"
-        "4. Immediate Corrective Actions\n"
-        "5. Follow-up Recommendations\n\n"
-        "Keep it concise and only based on the content provided."
-    )
-
-    response = client.chat.completions.create(
-        model=MODEL_SUMMARY,
-        messages=[
-            {"role": "system", "content": prompt},
-            {"role": "user", "content": report_text[:15000]},
-        ],
-        temperature=0,
-    )
-
-    return response.choices[0].message.content.strip()
-
-
-def chat_with_report(user_text: str, report_text: str, summary: str, history: list):
-    system_prompt = (
-        "You are the Duravant Digital Assistant. Answer questions ONLY using:\n"
-        "- The uploaded report\n"
-        "- The summary\n"
-        "- The chat history\n\n"
-        "If the user asks something not in the report, say: "
-        "'The report does not contain that information.'"
-    )
-
-    messages = [{"role": "system", "content": system_prompt}]
-
-    # Add context
-    context = (
-        "=== SUMMARY ===\n" + summary[:6000] +
-        "\n\n=== REPORT CONTENT (trimmed) ===\n" + report_text[:15000]
-    )
-    messages.append({"role": "assistant", "content": context})
-
-    # Add previous conversation
-    for turn in history:
-        messages.append(turn)
-
-    # Add new question
-    messages.append({"role": "user", "content": user_text})
-
-    response = client.chat.completions.create(
-        model=MODEL_CHAT,
-        messages=messages,
-        temperature=0,
-    )
-
-    return response.choices[0].message.content.strip()
-
-
-# ---------- Session State ----------
-def init_state():
-    for key in ["report_text", "summary", "chat_history", "last_file"]:
-        if key not in st.session_state:
-            st.session_state[key] = None if key != "chat_history" else []
-
-
-def reset_chat():
-    st.session_state.chat_history = []
+        st.info("Reading and summarizing report...")
 
 
 # ---------- MAIN ----------
@@ -175,19 +109,55 @@ def main():
         st.markdown("---")
         st.caption("Examples: downtime reports, service reports, quality logs, maintenance logs, change requests.")
 
-    # New file uploaded
-    if uploaded and uploaded.name != st.session_state.last_file:
-        with st.spinner("Reading and summarizing report..."):
-            report_text = load_report_text(uploaded)
-            st.session_state.report_text = report_text
-            st.session_state.summary = generate_summary(report_text)
-            st.session_state.last_file = uploaded.name
-            reset_chat()
-        st.success("Summary generated. Scroll down to review.")
+    # New file uploaded (identified by content, so renamed copies are not
+    # re-summarized). Hashed once per upload, not on every rerun
+    key = None
+    if uploaded is not None:
+        upload_key = st.session_state.upload_key
+        if upload_key is not None and upload_key[0] == uploaded.file_id:
+            key = upload_key[1]
+        else:
+            file_bytes = uploaded.getvalue()
+            key = summary_cache_key(file_bytes) if file_bytes else None
+            st.session_state.upload_key = (uploaded.file_id, key)
+
+    job = st.session_state.summary_job
+    current = job["key"] if job else st.session_state.last_file_key
+    failure = st.session_state.summary_failure
+    failed = failure is not None and failure["key"] == key
+    if key and key != current and not failed:
+        file_bytes = uploaded.getvalue()
+
+        # A newer upload replaces the pending job; stop paying for the old one
+        if job is not None:
+            job["future"].cancel()
+
+        # A cache hit skips the LLM; a miss is summarized in the background
+        summary = get_summary_cache().get(key)
+        if summary is None:
+            buffer = StreamBuffer()
+            st.session_state.summary_job = {
+                "future": submit_async(
+                    summarize_pipeline(iter_report_sections(file_bytes, uploaded.name), buffer)
+                ),
+                "buffer": buffer,
+                "key": key,
+                "name": uploaded.name,
+            }
+        else:
+            st.session_state.summary_job = None
+            set_report(load_report_text(file_bytes, uploaded.name), summary, key, uploaded.name)
 
     # Summary Section
     st.subheader("Report Summary")
-    if st.session_state.summary:
+    if st.session_state.summary_job is not None:
+        st.fragment(show_summary_progress, run_every=0.5)()
+    elif failed:
+        st.error(f"The summary could not be generated: {failure['error']}")
+        if st.button("Retry summary"):
+            st.session_state.summary_failure = None
+            st.rerun()
+    elif st.session_state.summary:
         st.markdown(st.session_state.summary)
     else:
         st.info("Upload a report to generate a summary.")
@@ -209,19 +179,92 @@ def main():
             # Show user message
             st.chat_message("user").markdown(user_input)
 
-            # Generate reply
-            reply = chat_with_report(
-                user_input,
-                st.session_state.report_text,
-                st.session_state.summary,
-                st.session_state.chat_history,
+            # Collect the rolling summary started after the previous turn; if it
+            # failed, keep the previous summary and offset (the next turn retries)
+            job, st.session_state.history_job = st.session_state.history_job, None
+            if job is not None:
+                try:
+                    (
+                        st.session_state.history_summary,
+                        st.session_state.summarized_turns,
+                    ) = job.result()
+                except Exception:
+                    pass
+
+            # Several listed questions go out as one request
+            questions = split_questions(user_input)
+            prompt = format_questions(user_input, len(questions)) if questions else user_input
+
+            # Single questions skip the LLM when they closely match a report
+            # sentence, or paraphrase an earlier opening question on this report.
+            # Follow-ups depend on the conversation, so they are never cached
+            answers = st.session_state.answer_cache.setdefault(
+                st.session_state.last_file_key, []
             )
-
-            st.chat_message("assistant").markdown(reply)
+            instant = embedding = embedding_job = None
+            if not questions:
+                instant = match_locally(user_input, st.session_state.report_sentences)
+                if instant is None and not st.session_state.chat_history:
+                    if answers:
+                        embedding = run_async(embed_text(user_input))
+                        instant = lookup_answer(answers, embedding)
+                    else:
+                        # Nothing to match yet: embed alongside the chat request,
+                        # only to store its answer
+                        embedding_job = submit_async(embed_text(user_input))
+
+            if instant:
+                st.chat_message("assistant").markdown(instant)
+                replies = [instant]
+            else:
+                # Stream reply
+                slot = st.empty()
+                with slot.container(), st.chat_message("assistant"):
+                    buffer = StreamBuffer()
+                    future = submit_async(
+                        chat_with_report(
+                            prompt,
+                            st.session_state.report_msg,
+                            st.session_state.chat_history[st.session_state.summarized_turns:],
+                            st.session_state.history_summary,
+                            buffer,
+                            excerpts=relevant_excerpts(
+                                user_input, st.session_state.report_overflow
+                            ),
+                        )
+                    )
+                    st.write_stream(iter_streaming(future, buffer))
+                    reply = future.result()
+
+                if embedding_job is not None:
+                    try:
+                        embedding = embedding_job.result()
+                    except Exception:
+                        pass
+                if embedding is not None:
+                    answers.append((embedding, reply))
+
+                # One bubble per answer for batches
+                replies = split_answers(reply, len(questions)) if questions else [reply]
+                if len(replies) > 1:
+                    with slot.container():
+                        for r in replies:
+                            st.chat_message("assistant").markdown(r)
 
             # Store in history
             st.session_state.chat_history.append({"role": "user", "content": user_input})
-            st.session_state.chat_history.append({"role": "assistant", "content": reply})
+            for r in replies:
+                st.session_state.chat_history.append({"role": "assistant", "content": r})
+
+            # Keep the prompt bounded for the next turn (display history stays
+            # intact); runs in the background while the user reads the reply
+            st.session_state.history_job = submit_async(
+                update_history_summary(
+                    list(st.session_state.chat_history),
+                    st.session_state.history_summary,
+                    st.session_state.summarized_turns,
+                )
+            )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,887 @@
+# core.py
+
+import os
+import io
+import re
+import atexit
+import asyncio
+import math
+import hashlib
+import functools
+import importlib.util
+import multiprocessing
+import tempfile
+import threading
+from collections import Counter
+from typing import TYPE_CHECKING, Final
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+import streamlit as st
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+
+# openai, pandas and the PDF readers are imported where they are first used
+# (PDF worker processes import this module too); optional packages are only
+# probed here, once
+
+# Optional PDF support (pypdfium2 is native and much faster; pypdf is the fallback)
+HAS_PDFIUM = importlib.util.find_spec("pypdfium2") is not None
+HAS_PYPDF = importlib.util.find_spec("pypdf") is not None
+
+# Optional multi-threaded CSV parsing
+HAS_PYARROW = importlib.util.find_spec("pyarrow") is not None
+
+# Optional Rust-backed Excel reader (pandas' "calamine" engine)
+HAS_CALAMINE = importlib.util.find_spec("python_calamine") is not None
+
+# Optional exact token counting
+HAS_TIKTOKEN = importlib.util.find_spec("tiktoken") is not None
+
+# Optional local answer lookup
+HAS_RAPIDFUZZ = importlib.util.find_spec("rapidfuzz") is not None
+
+
+# ---------- OpenAI client ----------
+# Event loop -> client bound to it (an aiohttp session is tied to its loop)
+_clients = {}
+
+
+def _close_client(loop, client):
+    if loop.is_running():
+        asyncio.run_coroutine_threadsafe(client.close(), loop).result(timeout=5)
+
+
+# One event loop on a background thread and one pooled client on it, shared by
+# every session and rerun
+@st.cache_resource
+def get_loop() -> asyncio.AbstractEventLoop:
+    from openai import AsyncOpenAI, DefaultAioHttpClient
+
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    client = AsyncOpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        http_client=DefaultAioHttpClient(),
+        max_retries=2,
+        timeout=60.0,
+    )
+    _clients[loop] = client
+    atexit.register(_close_client, loop, client)
+    return loop
+
+
+def get_client() -> "AsyncOpenAI":
+    # Called from coroutines, which run off the script thread
+    return _clients[asyncio.get_running_loop()]
+
+
+def submit_async(coro) -> Future:
+    return asyncio.run_coroutine_threadsafe(coro, get_loop())
+
+
+def run_async(coro):
+    return submit_async(coro).result()
+
+
+class StreamBuffer:
+    # Stand-in placeholder for coroutines running on the shared loop; the
+    # script thread renders .text (see iter_streaming), since Streamlit calls must stay on it
+    def __init__(self):
+        self.text = ""
+
+    def markdown(self, text: str):
+        self.text = text
+
+
+def iter_streaming(future: Future, buffer: StreamBuffer):
+    # Yields new text as the coroutine streams it, for st.write_stream
+    # Polls with wait() rather than result(timeout=...): the coroutine's own
+    # TimeoutError would otherwise look like "still running" forever
+    sent = 0
+    while True:
+        done = bool(wait([future], timeout=0.1).done)
+        text = buffer.text
+        if len(text) > sent:
+            yield text[sent:]
+            sent = len(text)
+        if done:
+            future.result()
+            return
+
+
+MODEL_SUMMARY = "gpt-4.1-mini"
+MODEL_CHAT = "gpt-4.1-mini"
+
+# System prompts are fixed strings (never formatted) so request prefixes stay
+# byte-identical and OpenAI's prompt cache can match them
+SUMMARY_SYSTEM_PROMPT: Final[str] = (
+    "You are the Duravant Digital Assistant. Summarize the following report using this structure:\n\n"
+    "1. Summary of Issue or Topic\n"
+    "2. Technical Findings / Key Details\n"
+    "3. Business Impact\n"
+    "4. Immediate Corrective Actions\n"
+    "5. Follow-up Recommendations\n\n"
+    "Keep it concise and only based on the content provided."
+)
+CHUNK_SUMMARY_PROMPT: Final[str] = (
+    "You are the Duravant Digital Assistant. Summarize this part of a larger report. "
+    "Keep every technical finding, figure, business impact and action item it mentions. "
+    "Only use the content provided."
+)
+CHAT_SYSTEM_PROMPT: Final[str] = (
+    "You are the Duravant Digital Assistant. Answer questions ONLY using:\n"
+    "- The uploaded report\n"
+    "- The summary\n"
+    "- The chat history\n\n"
+    "If the user asks something not in the report, say: "
+    "'The report does not contain that information.'"
+)
+HISTORY_SUMMARY_PROMPT: Final[str] = (
+    "Summarize the following dialogue in at most 200 tokens. "
+    "Keep the facts, figures and conclusions that were discussed."
+)
+
+# Map-reduce summary: ~3500 tokens per chunk, bounded fan-out
+SUMMARY_CHUNK_TOKENS = 3500
+MAX_SUMMARY_CHUNKS = 20
+MAX_CONCURRENT_REQUESTS = 8
+# Input to the final (reduce) summary call
+SUMMARY_INPUT_TOKENS = 16000
+
+# Chat context: a condensed report block that is the same every turn, plus
+# excerpts from the rest of the report picked per question
+REPORT_CONTEXT_TOKENS = 8000
+SUMMARY_CONTEXT_TOKENS = 1500
+EXCERPT_TOKENS = 1500
+BOILERPLATE_LINE = re.compile(r"^(page \d+( of \d+)?|\d+|confidential.*)$", re.IGNORECASE)
+
+# Changes whenever the summary prompts do, so cached summaries are not reused
+SUMMARY_PROMPT_VERSION = hashlib.sha256(
+    (SUMMARY_SYSTEM_PROMPT + CHUNK_SUMMARY_PROMPT).encode()
+).hexdigest()[:12]
+MAX_CACHED_SUMMARIES = 128
+MAX_CACHED_PARTIALS = 1024
+
+# Chat: exchanges kept verbatim; older ones are folded into a rolling summary
+HISTORY_TURNS = 4
+
+# Several listed questions are answered in one request, up to this many
+MAX_BATCH_QUESTIONS = 10
+
+# A report sentence covering a question's key terms at least this well (and
+# saying more than the question) is returned without calling the LLM
+LOCAL_MATCH_SCORE = 85
+# Questions with fewer key terms are too vague to answer with a single sentence
+LOCAL_MATCH_MIN_TERMS = 2
+QUESTION_STOPWORDS = frozenset({
+    "what", "which", "who", "whom", "whose", "when", "where", "why", "how",
+    "was", "were", "are", "the", "did", "does", "has", "have", "had", "and",
+    "for", "that", "this", "there", "about", "with", "from", "any", "can",
+})
+
+# Paraphrases of an earlier question on the same report reuse its answer
+EMBEDDING_MODEL = "text-embedding-3-small"
+ANSWER_CACHE_SIMILARITY = 0.95
+
+
+# ---------- File parsing ----------
+# Bound table size so large exports stay within the summary budget
+MAX_ROWS = 2000
+# Text past what the summary pipeline can consume is never used, so stop extracting there
+MAX_REPORT_CHARS = SUMMARY_CHUNK_TOKENS * 4 * MAX_SUMMARY_CHUNKS
+# Plain text is decoded only up to that budget (a cut multi-byte char is dropped)
+TEXT_BUDGET = MAX_REPORT_CHARS
+
+# Uploads parsed as tables (one row per line)
+TABLE_EXTENSIONS = (".csv", ".xlsx", ".xls")
+
+# PDFs with enough pages are extracted in worker processes, a slice of pages per task
+PDF_WORKERS = min(4, os.cpu_count() or 1)
+PDF_PAGES_PER_TASK = 8
+# Below two tasks' worth there is no parallelism to pay for the spawn and IPC
+PARALLEL_PDF_MIN_PAGES = 2 * PDF_PAGES_PER_TASK
+
+
+# PDFium is not thread-safe, even across documents, and is called from script
+# threads and to_thread workers alike, so every pdfium call takes this lock
+_pdfium_lock = threading.Lock()
+
+
+def open_pdf(source):
+    # Accepts a file object or a path; returns None if the PDF cannot be read
+    if HAS_PDFIUM:
+        import pypdfium2 as pdfium
+
+        with _pdfium_lock:
+            try:
+                return pdfium.PdfDocument(source)
+            except pdfium.PdfiumError:
+                return None
+
+    import pypdf
+
+    reader = pypdf.PdfReader(source)
+    if reader.is_encrypted:
+        # Try the empty password once instead of failing on every page;
+        # decrypt reports a wrong password rather than raising
+        try:
+            if reader.decrypt("") == pypdf.PasswordType.NOT_DECRYPTED:
+                return None
+        except:
+            return None
+    return reader
+
+
+def close_pdf(pdf):
+    if HAS_PDFIUM:
+        with _pdfium_lock:
+            pdf.close()
+
+
+def page_count(pdf) -> int:
+    if HAS_PDFIUM:
+        with _pdfium_lock:
+            return len(pdf)
+    return len(pdf.pages)
+
+
+def page_text(pdf, index: int) -> str:
+    if HAS_PDFIUM:
+        with _pdfium_lock:
+            page = pdf[index]
+            textpage = page.get_textpage()
+            text = textpage.get_text_range()
+            textpage.close()
+            page.close()
+        return text
+
+    try:
+        return pdf.pages[index].extract_text() or ""
+    except:
+        return ""
+
+
+def extract_pdf_pages(path: str, start: int, stop: int) -> list:
+    # Runs in a worker process
+    pdf = open_pdf(path)
+    if pdf is None:
+        return [""] * (stop - start)
+    try:
+        return [page_text(pdf, i) for i in range(start, stop)]
+    finally:
+        close_pdf(pdf)
+
+
+# One pool per process; "spawn" because forking a threaded server is unsafe
+@st.cache_resource
+def get_pdf_pool() -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(
+        max_workers=PDF_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+    )
+
+
+def iter_pdf_pages_parallel(bytes_data: bytes, count: int):
+    # Workers open the PDF from a temp file, so the bytes are not pickled per task
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp:
+        tmp.write(bytes_data)
+
+    pool = get_pdf_pool()
+    futures = []
+    done = 0
+    try:
+        for start in range(0, count, PDF_PAGES_PER_TASK):
+            stop = min(start + PDF_PAGES_PER_TASK, count)
+            futures.append(pool.submit(extract_pdf_pages, tmp.name, start, stop))
+        for future in futures:
+            for text in future.result():
+                yield text
+                done += 1
+    except BrokenProcessPool:
+        # A worker died (e.g. PDFium crashed on this file); replace the pool for
+        # later uploads. The rest is not retried in-process, where the same crash
+        # would take down the server
+        pool.shutdown(wait=False, cancel_futures=True)
+        get_pdf_pool.clear()
+        yield f"[Pages {done + 1}-{count} could not be extracted.]"
+    finally:
+        for future in futures:
+            future.cancel()
+        os.unlink(tmp.name)
+
+
+def extract_text_from_pdf(file):
+    # Yields page by page so summarization can start before the last page is read
+    if not (HAS_PDFIUM or HAS_PYPDF):
+        yield "PDF support not available. Install pypdfium2 or pypdf."
+        return
+
+    pdf = open_pdf(file)
+    if pdf is None:
+        yield "PDF could not be opened (it may be password protected)."
+        return
+
+    try:
+        count = page_count(pdf)
+        if count < PARALLEL_PDF_MIN_PAGES or PDF_WORKERS < 2:
+            pages = (page_text(pdf, i) for i in range(count))
+        else:
+            pages = iter_pdf_pages_parallel(file.getvalue(), count)
+
+        # Stop once the cap is reached; pending pages are never rendered
+        total = 0
+        try:
+            for text in pages:
+                yield text
+                total += len(text) + 2
+                if total >= MAX_REPORT_CHARS:
+                    break
+        finally:
+            pages.close()
+    finally:
+        close_pdf(pdf)
+
+
+def df_to_llm(df, max_rows: int = MAX_ROWS) -> str:
+    # Empty columns and float noise only cost tokens
+    df = df.dropna(axis=1, how="all").round(4)
+
+    # Long tables keep their head and tail, each with its own header row.
+    # Pipe-separated with no column padding, so whitespace costs no tokens
+    omitted = len(df) - max_rows
+    if omitted > 0:
+        half = max_rows // 2
+        parts = [df.iloc[:half], df.iloc[-(max_rows - half):]]
+    else:
+        parts = [df]
+
+    text = [p.to_csv(sep="|", index=False, lineterminator="\n") for p in parts]
+
+    if omitted > 0:
+        return f"{text[0]}\n... {omitted} rows omitted ...\n{text[1]}"
+    return text[0]
+
+
+def extract_text_from_csv(file) -> str:
+    import pandas as pd
+
+    df = None
+    if HAS_PYARROW:
+        try:
+            df = pd.read_csv(file, engine="pyarrow", dtype_backend="pyarrow")
+        except ValueError:
+            # Arrow's parser is stricter; retry odd files with the default engine
+            file.seek(0)
+    if df is None:
+        df = pd.read_csv(file)
+    return df_to_llm(df)
+
+
+def extract_text_from_excel(file) -> str:
+    import pandas as pd
+
+    # All sheets in one pass; calamine is much faster than openpyxl when installed
+    engine = "calamine" if HAS_CALAMINE else None
+    sheets = pd.read_excel(file, sheet_name=None, engine=engine)
+
+    def format_sheet(item):
+        sheet, df = item
+        return f"== Sheet: {sheet} ==\n{df_to_llm(df)}"
+
+    # Sheets are independent, so serialize them concurrently (map keeps sheet order)
+    with ThreadPoolExecutor(max_workers=max(1, min(8, len(sheets)))) as ex:
+        out = list(ex.map(format_sheet, sheets.items()))
+    return "\n\n".join(out)
+
+
+# Table parsing is all-or-nothing, so it is cached on the file bytes; the
+# summary pipeline and load_report_text share the result
+@st.cache_data(show_spinner=False, max_entries=32, ttl=3600)
+def extract_text_from_csv_bytes(bytes_data: bytes) -> str:
+    return extract_text_from_csv(io.BytesIO(bytes_data))
+
+
+@st.cache_data(show_spinner=False, max_entries=32, ttl=3600)
+def extract_text_from_excel_bytes(bytes_data: bytes) -> str:
+    return extract_text_from_excel(io.BytesIO(bytes_data))
+
+
+def iter_report_sections(bytes_data: bytes, name: str):
+    if not bytes_data:
+        return
+
+    name = name.lower()
+
+    # Binary parsers get a view over the same bytes (BytesIO shares its
+    # initial buffer until written to); text is decoded straight from the bytes
+    if name.endswith(".pdf"):
+        yield from extract_text_from_pdf(io.BytesIO(bytes_data))
+    elif name.endswith(".csv"):
+        yield extract_text_from_csv_bytes(bytes_data)
+    elif name.endswith((".xlsx", ".xls")):
+        yield extract_text_from_excel_bytes(bytes_data)
+    elif name.endswith(".txt"):
+        yield bytes_data[:TEXT_BUDGET].decode("utf-8", errors="ignore")
+    else:
+        try:
+            yield bytes_data[:TEXT_BUDGET].decode("utf-8", errors="ignore")
+        except:
+            yield "Unsupported file format."
+
+
+# Keyed on the file content, so reruns and re-uploads skip parsing
+@st.cache_data(show_spinner=False, max_entries=32, ttl=3600)
+def load_report_text(bytes_data: bytes, name: str) -> str:
+    buf = io.StringIO()
+    for i, section in enumerate(iter_report_sections(bytes_data, name)):
+        if i:
+            buf.write("\n\n")
+        buf.write(section)
+    return buf.getvalue()
+
+
+# ---------- Report compression ----------
+@functools.lru_cache(maxsize=1)
+def get_encoding():
+    import tiktoken
+
+    try:
+        return tiktoken.encoding_for_model(MODEL_CHAT)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+# Large inputs (report, summary) are truncated repeatedly, so their encodings are cached
+@functools.lru_cache(maxsize=256)
+def encode(text: str) -> tuple:
+    return tuple(get_encoding().encode_ordinary(text))
+
+
+def count_tokens(text: str) -> int:
+    if HAS_TIKTOKEN:
+        return len(get_encoding().encode_ordinary(text))
+    return len(text) // 4
+
+
+def count_tokens_batch(texts: list) -> list:
+    if HAS_TIKTOKEN:
+        return [len(t) for t in get_encoding().encode_ordinary_batch(texts)]
+    return [len(t) // 4 for t in texts]
+
+
+def split_chunks(text: str, budget: int, limit: int) -> tuple:
+    # (up to `limit` chunks of `budget` tokens, rest) from a single encode;
+    # ~4 chars per token without tiktoken. Once `limit` is reached the rest
+    # would be discarded, so it is not decoded
+    if not HAS_TIKTOKEN:
+        tokens, decode = text, "".join
+        budget *= 4
+    else:
+        enc = get_encoding()
+        tokens, decode = enc.encode_ordinary(text), enc.decode
+    count = min(len(tokens) // budget, limit)
+    chunks = [decode(tokens[i * budget:(i + 1) * budget]) for i in range(count)]
+    rest = "" if count == limit else decode(tokens[count * budget:])
+    return chunks, rest
+
+
+def truncate_tokens(text: str, budget: int) -> str:
+    # Cut at a token boundary; ~4 chars per token without tiktoken
+    if not HAS_TIKTOKEN:
+        return text[:budget * 4]
+    tokens = encode(text)
+    return text if len(tokens) <= budget else get_encoding().decode(tokens[:budget])
+
+
+@functools.lru_cache(maxsize=None)
+def prompt_tokens(prompt: str) -> int:
+    # Counted once per prompt constant (the tokenizer is loaded on first use, not at import)
+    return count_tokens(prompt)
+
+
+def compact_sentences(report_text: str, tabular: bool = False) -> list:
+    # Lines split into sentences, minus page furniture and exact repeats
+    # (e.g. table headers repeated on every page). Table rows are data:
+    # duplicates and bare numbers are real rows, so they are kept as-is
+    if tabular:
+        return [line for line in report_text.splitlines() if line.strip()]
+
+    seen = set()
+    out = []
+    for line in report_text.splitlines():
+        line = line.strip()
+        if not line or BOILERPLATE_LINE.match(line):
+            continue
+        for sentence in split_sentences(line):
+            if sentence not in seen:
+                seen.add(sentence)
+                out.append(sentence)
+    return out
+
+
+def fit_budget(sentences: list, budget: int) -> int:
+    # Number of leading sentences that fit in the token budget
+    used = 0
+    for i, tokens in enumerate(count_tokens_batch(sentences)):
+        used += tokens + 1
+        if used > budget:
+            return i
+    return len(sentences)
+
+
+def _terms(text: str) -> list:
+    return [t for t in re.findall(r"[a-z0-9]+", text.lower()) if len(t) > 2]
+
+
+def relevant_excerpts(question: str, sentences: list, budget: int = EXCERPT_TOKENS) -> str:
+    # TF-IDF score of each sentence against the question; the best ones that
+    # fit the budget are returned in report order
+    terms = set(_terms(question))
+    if not terms or not sentences:
+        return ""
+
+    docs = [_terms(s) for s in sentences]
+    df = Counter(t for d in docs for t in set(d) if t in terms)
+    idf = {t: math.log((1 + len(docs)) / (1 + n)) + 1 for t, n in df.items()}
+
+    scores = []
+    for i, d in enumerate(docs):
+        hits = Counter(t for t in d if t in idf)
+        if hits:
+            scores.append((sum(c * idf[t] for t, c in hits.items()) / len(d), i))
+
+    picked, used = [], 0
+    for _, i in sorted(scores, reverse=True):
+        used += count_tokens(sentences[i]) + 1
+        if used > budget:
+            break
+        picked.append(i)
+    return "\n".join(sentences[i] for i in sorted(picked))
+
+
+# ---------- LLM handlers ----------
+async def stream_completion(model: str, messages: list, placeholder=None) -> str:
+    # Render tokens into the placeholder as they arrive
+    stream = await get_client().chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=0,
+        stream=True,
+    )
+
+    acc = ""
+    async for chunk in stream:
+        if not chunk.choices:
+            continue
+        acc += chunk.choices[0].delta.content or ""
+        if placeholder is not None:
+            placeholder.markdown(acc)
+
+    return acc.strip()
+
+
+async def generate_summary(report_text: str, placeholder=None) -> str:
+    return await stream_completion(
+        MODEL_SUMMARY,
+        [
+            {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+            {"role": "user", "content": truncate_tokens(report_text, SUMMARY_INPUT_TOKENS)},
+        ],
+        placeholder,
+    )
+
+
+# Partial summaries by chunk content, shared by every session in the process.
+# Chunking is deterministic, so re-uploads and reports sharing a prefix reuse them
+_partial_summaries = {}
+
+
+async def summarize_chunk(text: str, semaphore: asyncio.Semaphore) -> str:
+    digest = hashlib.sha256(text.encode()).hexdigest()
+    key = f"{MODEL_SUMMARY}:{SUMMARY_PROMPT_VERSION}:{digest}"
+    if key in _partial_summaries:
+        return _partial_summaries[key]
+
+    async with semaphore:
+        response = await get_client().chat.completions.create(
+            model=MODEL_SUMMARY,
+            messages=[
+                {"role": "system", "content": CHUNK_SUMMARY_PROMPT},
+                {"role": "user", "content": text},
+            ],
+            temperature=0,
+        )
+
+    partial = response.choices[0].message.content.strip()
+    _partial_summaries[key] = partial
+    while len(_partial_summaries) > MAX_CACHED_PARTIALS:
+        _partial_summaries.pop(next(iter(_partial_summaries)))
+    return partial
+
+
+async def summarize_pipeline(sections, placeholder=None):
+    # Map: summarize each chunk as soon as enough pages have been extracted.
+    # Reduce: merge the partial summaries into the structured summary.
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    sections = iter(sections)
+    report = io.StringIO()
+    tasks = []
+    chunk = ""
+    count = 0
+
+    try:
+        while True:
+            # Parse off the event loop so in-flight requests keep progressing
+            section = await asyncio.to_thread(next, sections, None)
+            if section is None:
+                break
+            if count:
+                report.write("\n\n")
+            report.write(section)
+            count += 1
+
+            # Past the map budget the text is only kept for the chat context
+            remaining = MAX_SUMMARY_CHUNKS - len(tasks)
+            if remaining <= 0:
+                continue
+            # Tokenizing is CPU-bound too, and the loop is shared by every session
+            chunk += section + "\n\n"
+            heads, chunk = await asyncio.to_thread(
+                split_chunks, chunk, SUMMARY_CHUNK_TOKENS, remaining
+            )
+            for head in heads:
+                tasks.append(asyncio.create_task(summarize_chunk(head, semaphore)))
+
+        report_text = report.getvalue()
+
+        # Short report: a single streamed call is enough
+        if not tasks:
+            return report_text, await generate_summary(report_text, placeholder)
+
+        if chunk.strip() and len(tasks) < MAX_SUMMARY_CHUNKS:
+            tasks.append(asyncio.create_task(summarize_chunk(chunk, semaphore)))
+        partials = await asyncio.gather(*tasks)
+        merged = "\n\n".join(
+            f"=== Part {i} ===\n{partial}" for i, partial in enumerate(partials, 1)
+        )
+        return report_text, await generate_summary(merged, placeholder)
+    finally:
+        # On cancellation (a newer upload replaced this job) stop the map
+        # requests still in flight; finished tasks ignore cancel()
+        for task in tasks:
+            task.cancel()
+
+
+def build_context(report_text: str, summary: str) -> dict:
+    # The report message, built once per report and reused as-is every turn.
+    # It sits right after the system prompt so the prefix stays byte-identical
+    # for OpenAI's prompt cache, and uploaded content stays out of the system role
+    return {
+        "role": "user",
+        "content": (
+            "=== SUMMARY ===\n" + truncate_tokens(summary, SUMMARY_CONTEXT_TOKENS) +
+            "\n\n=== REPORT CONTENT (condensed) ===\n" + report_text
+        ),
+    }
+
+
+async def chat_with_report(
+    user_text: str,
+    report_msg: dict,
+    history: list,
+    history_summary: str = None,
+    placeholder=None,
+    excerpts: str = "",
+):
+    # Per-question excerpts go with the question, after the cached prefix
+    if excerpts:
+        user_text += "\n\n=== RELEVANT REPORT EXCERPTS ===\n" + excerpts
+
+    # Earlier conversation, compressed
+    earlier = []
+    if history_summary:
+        earlier.append({
+            "role": "system",
+            "content": "[earlier conversation summary]\n" + history_summary,
+        })
+
+    # System + report first (stable prefix), then conversation, then the new question
+    messages = [
+        {"role": "system", "content": CHAT_SYSTEM_PROMPT},
+        report_msg,
+        *earlier,
+        *history,
+        {"role": "user", "content": user_text},
+    ]
+
+    return await stream_completion(MODEL_CHAT, messages, placeholder)
+
+
+async def update_history_summary(history: list, history_summary: str, summarized: int):
+    # Fold everything but the last HISTORY_TURNS exchanges into the rolling summary,
+    # so the prompt size stays constant however long the session runs
+    cut = len(history) - 2 * HISTORY_TURNS
+    if cut <= summarized:
+        return history_summary, summarized
+
+    dialogue = "\n".join(f"{t['role']}: {t['content']}" for t in history[summarized:cut])
+    if history_summary:
+        dialogue = "[earlier conversation summary]\n" + history_summary + "\n\n" + dialogue
+
+    response = await get_client().chat.completions.create(
+        model=MODEL_CHAT,
+        messages=[
+            {
+                "role": "system",
+                "content": HISTORY_SUMMARY_PROMPT,
+            },
+            {"role": "user", "content": dialogue},
+        ],
+        temperature=0,
+        max_tokens=300,
+    )
+
+    return response.choices[0].message.content.strip(), cut
+
+
+# ---------- Summary cache ----------
+def summary_cache_key(file_bytes: bytes) -> str:
+    digest = hashlib.sha256(file_bytes).hexdigest()
+    return f"{MODEL_SUMMARY}:{SUMMARY_PROMPT_VERSION}:{digest}"
+
+
+# One dict per process, so identical uploads in any session skip the LLM
+@st.cache_resource
+def get_summary_cache() -> dict:
+    return {}
+
+
+def remember_summary(key: str, summary: str):
+    cache = get_summary_cache()
+    cache[key] = summary
+    while len(cache) > MAX_CACHED_SUMMARIES:
+        cache.pop(next(iter(cache)))
+
+
+# ---------- Local lookup ----------
+def split_sentences(report_text: str) -> list:
+    return [s.strip() for s in re.split(r"(?<=[.!?])\s+", report_text) if s.strip()]
+
+
+def match_locally(user_text: str, sentences: list):
+    # In-process fuzzy match; returns None when the LLM should answer instead
+    if not HAS_RAPIDFUZZ or not sentences:
+        return None
+    terms = set(_terms(user_text)) - QUESTION_STOPWORDS
+    if len(terms) < LOCAL_MATCH_MIN_TERMS:
+        return None
+
+    from rapidfuzz import fuzz, process, utils
+
+    # Scoring only the key terms, token_set_ratio measures how well a sentence
+    # covers them (100 = every key term is in the sentence)
+    hits = process.extract(
+        " ".join(sorted(terms)),
+        sentences,
+        scorer=fuzz.token_set_ratio,
+        processor=utils.default_process,
+        score_cutoff=LOCAL_MATCH_SCORE,
+        limit=2,
+    )
+    # Several candidates means the question is ambiguous; a sentence with no
+    # other terms only restates the question
+    if len(hits) != 1:
+        return None
+    sentence = hits[0][0]
+    if not set(_terms(sentence)) - terms - QUESTION_STOPWORDS:
+        return None
+    return f"From report: {sentence}"
+
+
+# ---------- Answer cache ----------
+async def embed_text(text: str):
+    import numpy as np
+
+    response = await get_client().embeddings.create(model=EMBEDDING_MODEL, input=text)
+    return np.asarray(response.data[0].embedding, dtype=np.float32)
+
+
+def lookup_answer(answers: list, embedding):
+    # answers holds (embedding, answer) pairs; returns the answer to the most
+    # similar earlier question if it is close enough
+    if not answers:
+        return None
+
+    import numpy as np
+
+    keys = np.stack([k for k, _ in answers])
+    sims = keys @ embedding / (np.linalg.norm(keys, axis=1) * np.linalg.norm(embedding))
+    best = int(sims.argmax())
+    return answers[best][1] if sims[best] > ANSWER_CACHE_SIMILARITY else None
+
+
+# ---------- Question batching ----------
+QUESTION_LINE = re.compile(r"^\s*(?:[-*]|\d+[.)])\s+(.*\S)")
+ANSWER_MARKER = re.compile(r"^\s*\**Answer (\d+):\**\s*", re.MULTILINE)
+
+
+def split_questions(user_text: str) -> list:
+    # Two to MAX_BATCH_QUESTIONS bulleted / numbered lines count as a batch;
+    # longer lists go out as a plain message, since the whole text is sent
+    matches = [QUESTION_LINE.match(line) for line in user_text.splitlines()]
+    questions = [m.group(1) for m in matches if m]
+    return questions if 2 <= len(questions) <= MAX_BATCH_QUESTIONS else []
+
+
+def format_questions(user_text: str, count: int) -> str:
+    # The whole message goes out, so lines around the list (context,
+    # constraints) still reach the model
+    return (
+        f"The message below lists {count} questions. Answer each one separately, in order. "
+        f"Start each answer on its own line with 'Answer N:', numbering them 1 to {count}.\n\n"
+        + user_text
+    )
+
+
+def split_answers(reply: str, count: int) -> list:
+    # Falls back to the whole reply if the model did not keep the numbering
+    parts = ANSWER_MARKER.split(reply)
+    answers = [a.strip() for a in parts[2::2]]
+    numbers = [int(n) for n in parts[1::2]]
+    if numbers != list(range(1, count + 1)):
+        return [reply]
+    return answers
+
+
+# ---------- Session State ----------
+def init_state():
+    defaults = {
+        "report_text": None,
+        "summary": None,
+        "report_msg": None,
+        "report_sentences": [],
+        "report_overflow": [],
+        "answer_cache": {},
+        "chat_history": [],
+        "last_file_key": None,
+        "upload_key": None,
+        "summary_job": None,
+        "summary_failure": None,
+        "history_summary": None,
+        "summarized_turns": 0,
+        "history_job": None,
+    }
+    for key, value in defaults.items():
+        if key not in st.session_state:
+            st.session_state[key] = value
+
+    # Start the shared event loop (and its pooled client) up front
+    get_loop()
+
+
+def reset_chat():
+    st.session_state.chat_history = []
+    st.session_state.history_summary = None
+    st.session_state.summarized_turns = 0
+    st.session_state.history_job = None